@@ -0,0 +1,185 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Cython kernel for the sudoku solver, a compiled alternative to the Numba
+kernel in sudoku_numba.py without the JIT warmup. Build it with
+    python setup.py build_ext --inplace
+@author: fangfufu
+"""
+
+from libc.stdint cimport uint8_t, uint16_t, int64_t
+
+cdef extern from *:
+    int __builtin_popcount(unsigned int) nogil
+    int __builtin_ctz(unsigned int) nogil
+
+cdef struct State:
+    uint8_t board[81]
+    uint16_t row_mask[9]
+    uint16_t col_mask[9]
+    uint16_t box_mask[9]
+
+# The row, column and box of each square, indexed by the flat index
+# 9 * row + col, and the flat indices of the squares in each of the 27 units
+cdef int ROW_OF[81]
+cdef int COL_OF[81]
+cdef int BOX_OF[81]
+cdef int UNIT_CELLS[27][9]
+
+for _k in range(81):
+    ROW_OF[_k] = _k // 9
+    COL_OF[_k] = _k % 9
+    BOX_OF[_k] = (_k // 27) * 3 + (_k % 9) // 3
+for _i in range(9):
+    for _j in range(9):
+        UNIT_CELLS[_i][_j] = 9 * _i + _j
+        UNIT_CELLS[9 + _i][_j] = 9 * _j + _i
+        UNIT_CELLS[18 + _i][_j] = 9 * (3 * (_i // 3) + _j // 3) + \
+            3 * (_i % 3) + _j % 3
+
+cdef inline unsigned int candidates(State* s, int k) noexcept nogil:
+    ''' The bitmask of the numbers that can go into square k '''
+    return s.row_mask[ROW_OF[k]] & s.col_mask[COL_OF[k]] & \
+        s.box_mask[BOX_OF[k]]
+
+cdef inline void place(State* s, int k, int num) noexcept nogil:
+    ''' Fill square k with num '''
+    cdef uint16_t bit = ~(1 << (num - 1)) & 0x1FF
+    s.row_mask[ROW_OF[k]] &= bit
+    s.col_mask[COL_OF[k]] &= bit
+    s.box_mask[BOX_OF[k]] &= bit
+    s.board[k] = num
+
+cdef bint propagate(State* s) noexcept nogil:
+    '''
+    Fill in the naked and hidden singles until there are none left, see
+    SudokuState.propagate()
+
+    Returns:
+        False if we have reached a dead end, True otherwise
+    '''
+    cdef bint changed = True
+    cdef int k, u, i
+    cdef unsigned int choices, placed, seen_once, seen_twice, singles
+    while changed:
+        changed = False
+        # Naked singles
+        for k in range(81):
+            if s.board[k]:
+                continue
+            choices = candidates(s, k)
+            if choices == 0:
+                return False
+            if choices & (choices - 1) == 0:
+                place(s, k, __builtin_ctz(choices) + 1)
+                changed = True
+
+        # Hidden singles
+        for u in range(27):
+            placed = 0
+            seen_once = 0
+            seen_twice = 0
+            for i in range(9):
+                k = UNIT_CELLS[u][i]
+                if s.board[k]:
+                    placed |= 1 << (s.board[k] - 1)
+                else:
+                    choices = candidates(s, k)
+                    seen_twice |= seen_once & choices
+                    seen_once |= choices
+            if seen_once | placed != 0x1FF:
+                return False
+            singles = seen_once & ~seen_twice
+            if singles == 0:
+                continue
+            for i in range(9):
+                k = UNIT_CELLS[u][i]
+                if s.board[k]:
+                    continue
+                choices = candidates(s, k) & singles
+                if choices:
+                    if choices & (choices - 1):
+                        return False
+                    place(s, k, __builtin_ctz(choices) + 1)
+                    changed = True
+    return True
+
+cdef bint search(State* s, int64_t* steps, int64_t limit) noexcept nogil:
+    '''
+    Depth-first search with constraint propagation, see
+    sudoku_numba.solve_kernel()
+    '''
+    cdef int k, count, num
+    cdef int best = -1
+    cdef int best_count = 10
+    cdef unsigned int choices
+    cdef State saved
+    if not propagate(s):
+        return False
+
+    # Pick the empty square with the fewest valid choices
+    for k in range(81):
+        if s.board[k] == 0:
+            count = __builtin_popcount(candidates(s, k))
+            if count < best_count:
+                best = k
+                best_count = count
+    if best < 0:
+        return True
+
+    # Save the state, so we can backtrack
+    saved = s[0]
+    choices = candidates(s, best)
+    while choices:
+        if steps[0] >= limit:
+            return False
+        steps[0] += 1
+        num = __builtin_ctz(choices) + 1
+        choices &= choices - 1
+        place(s, best, num)
+        if search(s, steps, limit):
+            return True
+        s[0] = saved
+    return False
+
+cdef bint solve_c(uint8_t[::1] board, int64_t* steps,
+                  int64_t limit) noexcept nogil:
+    ''' Solve the board in place, the board must be valid '''
+    cdef State s
+    cdef int k
+    cdef uint16_t bit
+    for k in range(9):
+        s.row_mask[k] = 0x1FF
+        s.col_mask[k] = 0x1FF
+        s.box_mask[k] = 0x1FF
+    for k in range(81):
+        s.board[k] = board[k]
+        if board[k]:
+            bit = ~(1 << (board[k] - 1)) & 0x1FF
+            s.row_mask[ROW_OF[k]] &= bit
+            s.col_mask[COL_OF[k]] &= bit
+            s.box_mask[BOX_OF[k]] &= bit
+    if not search(&s, steps, limit):
+        return False
+    for k in range(81):
+        board[k] = s.board[k]
+    return True
+
+def solve(uint8_t[::1] board, int64_t limit):
+    '''
+    Solve a sudoku puzzle in place using depth-first search with constraint
+    propagation
+
+    Args:
+        board: uint8 array of the 81 squares, 0 for an empty square, it must
+            not break any of the rules
+        limit: the maximum step count before aborting
+
+    Returns:
+        (solved, steps), whether the puzzle has been solved, and the number of
+        branches tried
+    '''
+    cdef int64_t steps = 0
+    cdef bint solved
+    with nogil:
+        solved = solve_c(board, &steps, limit)
+    return solved, steps
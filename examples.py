@@ -7,6 +7,7 @@ Example sodoku puzzles to be tested
 """
 import numpy
 import time
+import sudoku
 from sudoku import SudokuSolver
 
 if __name__ == '__main__':
@@ -165,3 +166,21 @@ if __name__ == '__main__':
     solver.solve()
     print(solver)
     print("--- %s seconds ---" % (time.time() - start_time))
+    
+    # An extra clue that breaks the puzzle without clashing with any other
+    # clue, both solve_batch() paths should hand it back untouched
+    broken = hardest.copy()
+    broken[0, 1] = 2
+    solutions, solved = SudokuSolver.solve_batch([broken, hardest])
+    assert (solutions[0] == broken).all() and not solved[0]
+    assert solved[1]
+    if sudoku.solve_batch_kernel is not None:
+        kernel = sudoku.solve_batch_kernel
+        sudoku.solve_batch_kernel = None
+        try:
+            fallback = SudokuSolver.solve_batch([broken, hardest])
+        finally:
+            sudoku.solve_batch_kernel = kernel
+        assert (fallback[0] == solutions).all()
+        assert (fallback[1] == solved).all()
+    print("solve_batch() agrees on an unsolvable puzzle")
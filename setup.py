@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Build the optional Cython kernel in place:
+    python setup.py build_ext --inplace
+@author: fangfufu
+"""
+
+from setuptools import setup, Extension
+from Cython.Build import cythonize
+
+setup(
+    name="SudokuSolver",
+    ext_modules=cythonize(
+        [Extension("_solver", ["_solver.pyx"],
+                   extra_compile_args=["-O3", "-march=native"])],
+        compiler_directives={"language_level": 3}),
+)
@@ -6,11 +6,82 @@ Sudoku solver using depth first search
 """
 
 import numpy
-import math
 import sys
 
+from sudoku_tables import ROW_OF, COL_OF, BOX_OF, UNIT_CELLS, PEERS, POPCNT
+
+try:
+    from sudoku_numba import solve_kernel, solve_batch_kernel
+except ImportError:
+    # Numba is optional, we fall back to the pure Python solver without it
+    solve_kernel = None
+    solve_batch_kernel = None
+
+try:
+    import _solver
+except ImportError:
+    # The Cython kernel is optional too, it needs building with setup.py
+    _solver = None
+
+# The bit standing for each number, 0 does not set any bit
+NUM_TO_BIT = numpy.array([0] + [1 << k for k in range(9)], dtype=numpy.uint16)
+
+# The bit position of each number, for splitting a mask into its bits
+DIGITS = numpy.arange(9, dtype=numpy.uint16)
+
+def gen_unit_masks(boards):
+    '''
+    Generate the bitmasks of the numbers missing from each unit
+    
+    Args:
+        boards: an array of shape (N, 81)
+        
+    Returns:
+        A uint16 array of shape (N, 27), bit k of each mask is set if number 
+        k+1 can still be placed in the unit. The units are in the same order
+        as in UNIT_CELLS.
+    Raises:
+        InvalidConfiguration: if a square holds anything but 0 to 9, or if a
+            number appears twice in a unit
+    '''
+    # Anything else would wrap around or index past NUM_TO_BIT
+    out_of_range = ((boards < 0) | (boards > 9)).any(axis=1)
+    if out_of_range.any():
+        raise InvalidConfiguration(boards[out_of_range.argmax()])
+    # Turn every square into its bit once, then gather them into units
+    bits = NUM_TO_BIT[boards][:, UNIT_CELLS]
+    used = numpy.bitwise_or.reduce(bits, axis=2)
+    # Without duplicates, summing the bits is the same as OR-ing them, a
+    # duplicate carries into another bit instead
+    invalid = bits.sum(axis=2) != used
+    if invalid.any():
+        p, u = numpy.argwhere(invalid)[0]
+        raise InvalidConfiguration(boards[p, UNIT_CELLS[u]])
+    return 0x1FF ^ used
+
+def gen_candidates(boards):
+    '''
+    Generate the candidates of every square
+    
+    Args:
+        boards: an array of shape (N, 81)
+        
+    Returns:
+        A uint16 array of shape (N, 81), bit k of each mask is set if number 
+        k+1 can go into the square. Filled squares have no candidates.
+    Raises:
+        InvalidConfiguration: if a number appears twice in a unit
+    '''
+    # A number can go into a square if it is missing from the row, the column
+    # and the box of the square
+    masks = gen_unit_masks(boards)
+    cand = masks[:, ROW_OF] & masks[:, [9 + j for j in COL_OF]] & \
+        masks[:, [18 + b for b in BOX_OF]]
+    cand[boards != 0] = 0
+    return cand
+
 class OutOfDecisions(Exception):
-    ''' For use by SudokuState, when running out of decisions'''
+    ''' For use by SudokuSolver, when running out of decisions'''
     pass
 
 class InvalidConfiguration(ValueError):
@@ -28,45 +99,35 @@ class SudokuState():
         config: The configuration to generate the state information for.
         
     Attributes:
-        valid_decisions: a 9x9x9 boolean numpy array indicating the valid 
-            decisions for each square
-        priority list: a list of tuples (row, col), indicating which squares 
-            should be filled first.
-        current_level: the square that needs to be tried, counting from the 
-            top of the priority list
-        current_choice: the last choice made at the current level, by combining
-            level and choice, we form a decision
-        decision_cache: a log of all the previous decisions made, not strictly
-            necessary, as we don't seem to visit previous decision in the
-            actual solver
+        config: a 9x9 uint8 numpy array of the squares, 0 for an empty square
+        cand: a uint16 numpy array of length 81, indexed by 9 * row + col, bit
+            k of cand[k] is set if number k+1 can go into the square. Filled
+            squares have no candidates.
+        packed: config packed into an int, 4 bits per square with square k
+            at bit 4k, kept up to date by place() and undo()
+        empties: the number of empty squares, kept up to date by place() and
+            undo()
     '''
     
     def __init__(self, config):
+        # The numbers fit in a byte, and numpy.array() always makes a copy
+        config = numpy.array(config, dtype=numpy.uint8)
         if config.shape != (9, 9):
                 raise ValueError("Invalid input configuration dimension")
-        self.config = config.copy()
-        self.valid_decisions = self.__gen_valid_decisions_array()
-        self.priority_list = self.__gen_priority_list()
-        self.current_level = 0
-        self.current_choice = 0
-        self.decision_cache = []
+        self.config = config
+        self.cand = gen_candidates(self.config.reshape(1, 81))[0]
+        self.packed = sum(num << 4 * k 
+                          for k, num in enumerate(self.config.ravel().tolist()))
+        self.empties = int((self.config == 0).sum())
         
     def __eq__(self, other):
-        return numpy.array_equal(self.config, other.config)
-    
-    def __ne__(self, other):
-        return not numpy.array_equal(self.config, other.config)
+        return self.packed == other.packed
     
     def __hash__(self):
-        return self.config.tobytes().__hash__()
+        # The hash follows place() and undo(), so a state must not be moved
+        # while it is in a set or used as a dict key
+        return hash(self.packed)
     
-    def __next__(self):
-        '''Make the class iterable'''
-        try:
-            return self.gen_config(len(self.decision_cache))
-        except OutOfDecisions:
-            raise StopIteration
-            
     def __repr__(self):
         return (self.config.__repr__()).replace("array", "SudokuState\n\t ")
     
@@ -76,32 +137,6 @@ class SudokuState():
             .replace("[[", "[").replace(" [","|") \
             .replace("]]", "|").replace("]","|") + "\n‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾"
     
-    @staticmethod
-    def __is_valid_unit(unit):
-        '''
-        Check if a unit has a valid configuration
-        
-        Args:
-            unit: a unit of 9 squares
-        Returns:
-            -1: invalid configuration
-             0: complete and valid configuration
-             positive int: incomplete configuration, the number of 0s remaining
-                 in the unit
-        '''
-        unit = unit.flatten()
-        assert(len(unit) == 9)
-        
-        # Note that we need to check for number 0-9, and there are 10 numbers!
-        check = [0] * 10
-        # Check if each number appear exactly once
-        for i in unit:
-            check[i] += 1
-            if check[i] > 1 and i != 0:
-                raise InvalidConfiguration(unit)
-        # return how many 0s are left. 
-        return check[0]
-
     def is_valid(self): 
         ''' 
         Check if a sudoku configuration is valid 
@@ -110,114 +145,128 @@ class SudokuState():
              0: complete and valid configuration
              positive int: incomplete configuration, the number of 0s remaining
                  in the puzzle
+        Raises:
+            InvalidConfiguration: if a number appears twice in a unit
         '''
-        for i in range(0,9):
-            # scan for rows and columns
-            self.__is_valid_unit(self.config[i, :]) < 0
-            self.__is_valid_unit(self.config[:, i]) < 0
+        gen_unit_masks(self.config.reshape(1, 81))
+        return self.empties
     
-        total = 0
-        for i in range(0,3):
-            for j in range(0,3):
-                total += self.__is_valid_unit(
-                        self.config[3*i:3*(i+1), 3*j:3*(j+1)])
-        
-        return total
+    
+    def candidates(self, row, col):
+        ''' The bitmask of the numbers that can go into square (row, col) '''
+        return int(self.cand[9 * row + col])
+    
+    def next_branches(self):
+        ''' 
+        Find the empty square with the fewest valid choices, i.e. the minimum
+        remaining values heuristic, ties go to the first square
         
-    def __gen_valid_decisions_array(self):
-        ''' Generate the valid decisions array '''
-        # Initially every number is possible in every square, as we discover
-        # existing numbers, they get masked out. 
-        # We use the value in the puzzle to do indexing directly, 
-        row_arr = numpy.full((9, 9), True)
-        col_arr = numpy.full((9, 9), True)
-        square_arr = numpy.full((3, 3, 9), True)
-        for i in range(0,9):
-            for j in range(0,9):
-                # Skip the 0s
-                if self.config[i,j] > 0:
-                    num = self.config[i,j] - 1
-                    row_arr[i, num] = False
-                    col_arr[j, num] = False
-                    square_arr[math.floor(i/3), math.floor(j/3), num] = False
-                    
-        # Calculate the valid decisions
-        valid_decisions = numpy.full((9, 9, 9), True)
-        for i in range(0,9):
-            for j in range(0,9):
-                valid_decisions[i,j] = row_arr[i] & col_arr[j] & \
-                square_arr[math.floor(i/3), math.floor(j/3)]
-        return valid_decisions
-                
-    def __gen_priority_list(self):
-        ''' Generate the priority list for a sudoku configuration '''
-        self.priority2d = numpy.sum(self.valid_decisions, 2)
-        prioritytbl = []
-        for i in range(0, 9):
-            for j in range(0, 9):
-                if self.config[i,j] == 0:
-                    prioritytbl.append((i, j, self.priority2d[i, j]))
-        return [(x[0], x[1]) for x in sorted(prioritytbl, key=lambda x: x[2]) 
-                              if x[2] != 0]
+        Returns:
+            (row, col, choices) of the square, choices being the bitmask of 
+            the numbers that can go into it, or None if there are no empty 
+            squares
+        '''
+        # Filled squares get a count no empty square can reach
+        counts = numpy.where(self.config.ravel() == 0, POPCNT[self.cand], 255)
+        k = int(counts.argmin())
+        if counts[k] == 255:
+            return None
+        return ROW_OF[k], COL_OF[k], int(self.cand[k])
     
-    def gen_decision(self, n):
+    def propagate(self, moves):
         '''
-        Generate the nth decision from a priority list and valid decisions pair
+        Fill in the squares that can only take one number, until there are no 
+        such squares left. A square can only take one number if it has a 
+        single valid choice (a naked single), or if it is the only square in
+        a unit where a number can go (a hidden single).
         
-        Args: 
-            n: the nth decision to generate
+        Args:
+            moves: the list to append the undo records of the moves to
             
         Returns:
-            The nth decision at the current configuration in the format of 
-            (row, col, num), so square at (row, col) needs to be filled with 
-            num. (0, 0, 0) will be returned if a decision cannot be generated.
+            False if we have reached a dead end, True otherwise
         '''
+        changed = True
+        while changed:
+            changed = False
+            # Naked singles
+            counts = POPCNT[self.cand]
+            if ((counts == 0) & (self.config.ravel() == 0)).any():
+                return False
+            for k in numpy.flatnonzero(counts == 1).tolist():
+                # An earlier single may have taken the number away
+                choices = int(self.cand[k])
+                if choices == 0:
+                    return False
+                moves.append(self.place(ROW_OF[k], COL_OF[k], 
+                                        choices.bit_length()))
+                changed = True
+            if changed:
+                continue
+            
+            # Hidden singles, count the squares in each unit each number can
+            # go into
+            units = self.cand[UNIT_CELLS]
+            counts = (units[:, :, None] >> DIGITS & 1).sum(axis=1)
+            placed = numpy.bitwise_or.reduce(
+                    NUM_TO_BIT[self.config.ravel()][UNIT_CELLS], axis=1)
+            # A number that cannot go anywhere in the unit
+            if ((counts == 0) & (placed[:, None] >> DIGITS & 1 == 0)).any():
+                return False
+            for u, d in numpy.argwhere(counts == 1).tolist():
+                bit = 1 << d
+                k = int(UNIT_CELLS[u, numpy.argmax(units[u] & bit)])
+                if not self.cand[k] & bit:
+                    # We may have found the same single through another unit
+                    if self.config.flat[k] == d + 1:
+                        continue
+                    return False
+                moves.append(self.place(ROW_OF[k], COL_OF[k], d + 1))
+                changed = True
+        return True
+    
+    def place(self, row, col, num):
+        '''
+        Fill a square in place
         
-        # We have cached the previous decisions for backtracking
-        if n < len(self.decision_cache):
-            return self.decision_cache[n]
-        
-        # Generate new decisions
-        for i in range(self.current_level, len(self.priority_list)):
-#            print("i: ", str(i))
-            self.current_level = i
-            coord = self.priority_list[i]
-            choices = self.valid_decisions[coord]
-            for j in range(self.current_choice, len(choices)):
-#                print("j: ", str(j))
-                self.current_choice = j
-                if choices[j]:
-                    self.decision_cache.append((coord[0], coord[1], j + 1))                  
-                    if n == (len(self.decision_cache) - 1):
-                        # Manually increase the loop counter by 1, because we
-                        # are exiting
-                        self.current_choice += 1
-                        if j == len(choices):
-                            self.current_choice == 0
-                            self.current_level += 1
-                        return self.decision_cache[-1]
-                if j == (len(choices) - 1):
-                    self.current_choice = 0
-               
-        # We have reached the end without getting a solution 
-        return (0, 0, 0)
+        Args:
+            row, col: the square to fill
+            num: the number to fill the square with
+            
+        Returns:
+            The undo record (row, col, cand, peer_cand), holding the 
+            candidates of the square and its peers from before the move
+        '''
+        k = 9 * row + col
+        peers = PEERS[k]
+        record = (row, col, self.cand[k], self.cand[peers])
+        # Only the peers of the square lose a choice
+        self.cand[peers] &= 0x1FF ^ (1 << (num - 1))
+        self.cand[k] = 0
+        self.config[row, col] = num
+        self.packed ^= num << 4 * k
+        self.empties -= 1
+        return record
     
-    def gen_config(self, n):
+    def undo(self, record):
         '''
-        Generate a new sudoku configuration based on the nth decision
+        Revert a move made by place()
         
         Args:
-            n: the nth new configuration to generate
+            record: the undo record returned by place()
             
         Returns:
-            The nth new sudoku configuration
+            The reverted move in the format of (row, col, num)
         '''
-        decision = self.gen_decision(n)
-        if decision == (0, 0, 0):
-            raise OutOfDecisions();
-        new_config = numpy.copy(self.config)
-        new_config[decision[0], decision[1]] = decision[2]
-        return SudokuState(new_config)
+        row, col, cand, peer_cand = record
+        k = 9 * row + col
+        num = int(self.config[row, col])
+        self.cand[PEERS[k]] = peer_cand
+        self.cand[k] = cand
+        self.config[row, col] = 0
+        self.packed ^= num << 4 * k
+        self.empties += 1
+        return row, col, num
         
     
 class SudokuSolver():
@@ -226,71 +275,199 @@ class SudokuSolver():
 
     Args:
         input_array: the puzzle that needs to be solved
-        limit: the maximun number of step to attempt before terminating
+        limit: the maximun number of step to attempt before terminating, 
+            solve() then returns the state it got to, which is partly filled
+            in by the Python solver, but is the puzzle as given when using a
+            compiled kernel
+        jit: whether to use a compiled kernel, the Cython kernel is used if
+            it has been built, otherwise the Numba kernel is used if Numba is
+            installed
+        verbose: print the solver every 10000 steps, the compiled kernels run
+            in one go, so they only print once at the end
+        progress_cb: a function to call with (step, stack length) every 10000
+            steps, or once at the end when using a compiled kernel. The
+            kernels do not report their search depth, so the stack length is
+            None then.
         
     Attributes:
-        state_stack: the sudoku configuration stack
-        generated_states: the sudoku configuration we have previously generated
+        state: the sudoku configuration, which gets filled in place
+        moves: the undo records of the moves made so far
+        branches: (position, tried) tuples, the positions in moves where we 
+            had more than one choice, and the bitmask of the numbers tried there
         solution: the sudoku solution
         self.limit: the maximum step count before aborting
-        step: the number of configuration generated in total so far
+        step: the number of numbers tried so far at the squares picked by 
+            the search, the moves forced by propagate() are not counted
+        jit: whether a compiled kernel is used
+        verbose: whether to print the progress
+        progress_cb: the function to report the progress to, or None
     '''
 
     def __init__(self, 
                  input_array, 
                  limit=sys.maxsize, 
-                 check_identical_state=True):
+                 jit=True,
+                 verbose=False,
+                 progress_cb=None):
         ''' Constructor '''
-        self.config_init = SudokuState(input_array)
-        validity = self.config_init.is_valid()
-        if validity == 0:
+        # SudokuState() has already checked the puzzle while building the 
+        # candidates
+        self.state = SudokuState(input_array)
+        if self.state.empties == 0:
             raise ValueError("The input puzzle has already been solved.")
         
-        # The configurations we have tried
-        self.state_stack = [self.config_init]
-        self.generated_states = set()
+        # The moves we have made
+        self.moves = []
+        self.branches = []
         self.solution = None
         self.step = 0
         self.limit = limit
+        self.jit = jit and (_solver is not None or solve_kernel is not None)
+        self.verbose = verbose
+        self.progress_cb = progress_cb
    
     def __str__(self):
         return "--- SudokuSolver --- \n" + \
             "Step count: " + str( self.step) + "\n" + \
-            "Generated length: " + str(self.generated_states.__len__()) + \
-            "\n" + \
-            "Stack length: " + str(self.state_stack.__len__()) + "\n" + \
-            self.state_stack[-1].__str__()
+            "Stack length: " + str(self.moves.__len__()) + "\n" + \
+            self.state.__str__()
             
     def __repr__(self):
         return "<SudokuSolver - " + \
             "step: " + str( self.step) + \
-            ", gen len: " + str(self.generated_states.__len__()) + \
-            ", stack len: " + str(self.state_stack.__len__()) +">"
+            ", stack len: " + str(self.moves.__len__()) +">"
             
-    def __getitem__(self, i):
-        return self.state_stack[i]
-    
     def solve(self):
         '''
         Solve a sudoku puzzle using depth-first search with backtracking
+        
+        The search is a tree, the branches at a square each put a different
+        number into it, so no configuration can come up twice and there is 
+        no need to remember the configurations we have seen.
         '''
-        # While we still have squares to fill, try and fill the squares
-        while self.state_stack[-1].is_valid() > 0 and  self.step < self.limit:
-            if not ( self.step % 10000):
-                print(self)
-            try:
-                self.step += 1
-                next_state = next(self.state_stack[-1])
-
-                if next_state in self.generated_states:
-                    continue
+        if self.jit:
+            return self.__solve_jit()
+        
+        state = self.state
+        # The bitmask of the numbers tried at the current square
+        tried = 0
+        dead_end = not state.propagate(self.moves)
+        # The step of the next progress report, comparing against it is 
+        # cheaper than a modulus every step, and it is never reached when 
+        # nobody is listening
+        report = 0 if self.verbose or self.progress_cb is not None else -1
+        # While we still have squares to fill, try and fill the squares. Every
+        # move is valid by construction, so there is no need for is_valid().
+        while state.empties and self.step < self.limit:
+            if self.step == report:
+                report += 10000
+                self.__report()
+            if dead_end:
+                choices = 0
+            else:
+                if tried == 0:
+                    row, col, choices = state.next_branches()
                 else:
-                    self.generated_states.add(next_state)
-                    self.state_stack.append(next_state)
-                    
-            except StopIteration:
-                self.state_stack.pop()
+                    # Mask out the numbers we have already tried
+                    choices = state.candidates(row, col) & ~tried
+            if choices:
+                # Only the numbers tried at the squares we pick count as steps,
+                # the same as in the compiled kernels
+                self.step += 1
+                # The lowest set bit is the next number to try
+                low = choices & -choices
+                # Forced moves are not branch points, we never come back to
+                # them when backtracking
+                if choices != low:
+                    self.branches.append((len(self.moves), tried | low))
+                self.moves.append(state.place(row, col, low.bit_length()))
+                tried = 0
+                dead_end = not state.propagate(self.moves)
+            elif self.branches:
+                # Unwind the forced moves back to the last branch point
+                branch, tried = self.branches.pop()
+                while len(self.moves) > branch + 1:
+                    state.undo(self.moves.pop())
+                row, col, _ = state.undo(self.moves.pop())
+                dead_end = False
+            else:
+                raise OutOfDecisions()
 
-        self.solution = self.state_stack[-1]
+        self.solution = state
         return self.solution
-                        
+    
+    @classmethod
+    def solve_batch(cls, puzzles, limit=sys.maxsize):
+        '''
+        Solve many sudoku puzzles at once, in parallel if Numba is available
+        
+        Args:
+            puzzles: an array of shape (N, 9, 9) or (N, 81)
+            limit: the maximun number of step to attempt for each puzzle
+            
+        Returns:
+            (solutions, solved), solutions is a uint8 array of shape 
+            (N, 9, 9), solved is a boolean array of length N indicating which puzzles 
+            have been solved. The unsolved puzzles are returned as given.
+        Raises:
+            InvalidConfiguration: if any of the puzzles is invalid
+        '''
+        # A wide type keeps the numbers out of range as they are for checking
+        boards = numpy.array(puzzles, dtype=numpy.int64).reshape(-1, 81)
+        # All the candidates are built at once, one row per puzzle, this also
+        # checks every puzzle, complete ones included, on both paths
+        cands = gen_candidates(boards)
+        boards = boards.astype(numpy.uint8)
+        if solve_batch_kernel is None:
+            solutions = boards.reshape(-1, 9, 9).copy()
+            solved = numpy.zeros(len(boards), dtype=bool)
+            for p in range(len(boards)):
+                if not solutions[p].all():
+                    solver = cls(solutions[p], limit)
+                    try:
+                        solutions[p] = solver.solve().config
+                    except OutOfDecisions:
+                        continue
+                solved[p] = not (solutions[p] == 0).any()
+            return solutions, solved
+        
+        # The kernel leaves the guesses of its last branch on a failed board
+        original = boards.copy()
+        steps = numpy.zeros((len(boards), 1), dtype=numpy.int64)
+        solved = solve_batch_kernel(boards, cands, steps, limit)
+        boards[~solved] = original[~solved]
+        return boards.reshape(-1, 9, 9), solved
+    
+    def __solve_jit(self):
+        '''
+        Solve a sudoku puzzle using a compiled kernel
+        '''
+        state = self.state
+        if _solver is not None:
+            board = state.config.ravel().copy()
+            solved, steps = _solver.solve(board, self.limit - self.step)
+        else:
+            board = state.config.ravel().copy()
+            counter = numpy.zeros(1, dtype=numpy.int64)
+            solved = solve_kernel(board, state.cand.copy(), counter, 
+                                  self.limit - self.step)
+            steps = int(counter[0])
+        self.step += steps
+        if solved:
+            state = self.state = SudokuState(board.reshape(9, 9))
+        # The kernel cannot call back into Python, so report once at the end
+        self.__report()
+        if not solved and self.step < self.limit:
+            raise OutOfDecisions()
+        
+        self.solution = state
+        return self.solution
+    
+    def __report(self):
+        '''
+        Report the progress, if verbose is set or progress_cb is given
+        '''
+        if self.verbose:
+            print(self)
+        if self.progress_cb is not None:
+            self.progress_cb(self.step, None if self.jit else len(self.moves))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Numba kernel for the sudoku solver, the board is a flat uint8 array of 81
+squares, and the valid choices are kept as a uint16 bitmask for each square
+@author: fangfufu
+"""
+
+import numpy
+from numba import njit, prange
+
+# Numba freezes the global arrays into the compiled code, so the kernels
+# share the tables of the Python solver without passing them in
+from sudoku_tables import UNIT_CELLS, PEERS, POPCNT
+
+@njit(cache=True, boundscheck=False)
+def _lowest_number(choices):
+    ''' The number represented by the lowest set bit of choices '''
+    low = choices & -choices
+    num = 1
+    while low > 1:
+        low >>= 1
+        num += 1
+    return num
+
+@njit(cache=True, boundscheck=False)
+def _place(board, cand, k, num):
+    ''' Fill square k with num, and take num away from its peers '''
+    mask = 0x1FF ^ (1 << (num - 1))
+    for i in range(20):
+        cand[PEERS[k, i]] &= mask
+    cand[k] = 0
+    board[k] = num
+
+@njit(cache=True, boundscheck=False)
+def _propagate(board, cand):
+    '''
+    Fill in the naked and hidden singles until there are none left, see
+    SudokuState.propagate()
+
+    Returns:
+        False if we have reached a dead end, True otherwise
+    '''
+    changed = True
+    while changed:
+        changed = False
+        # Naked singles
+        for k in range(81):
+            if board[k] != 0:
+                continue
+            choices = numpy.int64(cand[k])
+            if choices == 0:
+                return False
+            if choices & (choices - 1) == 0:
+                _place(board, cand, k, _lowest_number(choices))
+                changed = True
+
+        # Hidden singles
+        for u in range(27):
+            placed = 0
+            seen_once = 0
+            seen_twice = 0
+            for i in range(9):
+                k = UNIT_CELLS[u, i]
+                if board[k] != 0:
+                    placed |= 1 << (board[k] - 1)
+                else:
+                    choices = numpy.int64(cand[k])
+                    seen_twice |= seen_once & choices
+                    seen_once |= choices
+            if seen_once | placed != 0x1FF:
+                return False
+            singles = seen_once & ~seen_twice
+            if singles == 0:
+                continue
+            for i in range(9):
+                k = UNIT_CELLS[u, i]
+                if board[k] != 0:
+                    continue
+                choices = numpy.int64(cand[k]) & singles
+                if choices:
+                    if choices & (choices - 1):
+                        return False
+                    _place(board, cand, k, _lowest_number(choices))
+                    changed = True
+    return True
+
+@njit(cache=True, boundscheck=False)
+def solve_kernel(board, cand, steps, limit):
+    '''
+    Solve a sudoku puzzle in place using depth-first search with constraint
+    propagation
+
+    Args:
+        board: uint8 array of the 81 squares, 0 for an empty square
+        cand: uint16 array of length 81, bit k of cand[k] is set if number
+            k+1 can go into the square, filled squares have no candidates
+        steps: int64 array of length 1, counting the branches we have tried
+        limit: the maximum step count before aborting
+
+    Returns:
+        True if the puzzle has been solved, False otherwise
+    '''
+    # There is at most one branch point per square, each keeps the square,
+    # the numbers left to try, and the state to go back to
+    branch_square = numpy.empty(81, dtype=numpy.int64)
+    branch_choices = numpy.empty(81, dtype=numpy.int64)
+    saved_board = numpy.empty((81, 81), dtype=board.dtype)
+    saved_cand = numpy.empty((81, 81), dtype=cand.dtype)
+    depth = 0
+    while True:
+        if _propagate(board, cand):
+            # Pick the empty square with the fewest valid choices
+            best = -1
+            best_count = 10
+            for k in range(81):
+                if board[k] == 0 and POPCNT[cand[k]] < best_count:
+                    best = k
+                    best_count = POPCNT[cand[k]]
+            if best < 0:
+                return True
+            branch_square[depth] = best
+            branch_choices[depth] = cand[best]
+            saved_board[depth] = board
+            saved_cand[depth] = cand
+            depth += 1
+
+        # Backtrack to the last branch point with numbers left to try
+        while depth > 0 and branch_choices[depth - 1] == 0:
+            depth -= 1
+        if depth == 0 or steps[0] >= limit:
+            return False
+        steps[0] += 1
+        choices = branch_choices[depth - 1]
+        branch_choices[depth - 1] = choices & (choices - 1)
+        board[:] = saved_board[depth - 1]
+        cand[:] = saved_cand[depth - 1]
+        _place(board, cand, branch_square[depth - 1], _lowest_number(choices))
+
+@njit(cache=True, parallel=True)
+def solve_batch_kernel(boards, cands, steps, limit):
+    '''
+    Solve many sudoku puzzles in place in parallel, see solve_kernel()
+
+    Args:
+        boards: uint8 array of shape (N, 81)
+        cands: uint16 array of shape (N, 81)
+        steps: int64 array of shape (N, 1)
+        limit: the maximum step count for each puzzle
+
+    Returns:
+        Boolean array of length N, indicating which puzzles have been solved
+    '''
+    solved = numpy.zeros(boards.shape[0], dtype=numpy.bool_)
+    for p in prange(boards.shape[0]):
+        solved[p] = solve_kernel(boards[p], cands[p], steps[p], limit)
+    return solved
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lookup tables for the 9x9 sudoku board, shared by the Python solver and the
+Numba kernel
+@author: fangfufu
+"""
+
+import numpy
+
+# The row, column and box of each square, indexed by the flat index
+# 9 * row + col. The boxes are numbered from left to right, top to bottom.
+ROW_OF = [i for i in range(9) for j in range(9)]
+COL_OF = [j for i in range(9) for j in range(9)]
+BOX_OF = [(i // 3) * 3 + j // 3 for i in range(9) for j in range(9)]
+
+# The flat indices of the squares in each of the 27 units: rows, columns and
+# then boxes
+UNIT_CELLS = numpy.array(
+        [[k for k in range(81) if ROW_OF[k] == i] for i in range(9)] +
+        [[k for k in range(81) if COL_OF[k] == i] for i in range(9)] +
+        [[k for k in range(81) if BOX_OF[k] == i] for i in range(9)])
+
+# The flat indices of the 20 squares sharing a unit with each square
+PEERS = numpy.array([[p for p in range(81)
+                      if p != k and (ROW_OF[p] == ROW_OF[k] or
+                                     COL_OF[p] == COL_OF[k] or
+                                     BOX_OF[p] == BOX_OF[k])]
+                     for k in range(81)], dtype=numpy.int32)
+
+# The number of set bits in each 9 bit mask
+POPCNT = numpy.array([bin(i).count('1') for i in range(512)],
+                     dtype=numpy.uint8)